@@ -0,0 +1,173 @@
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import cdsapi
+import numpy as np
+import pytest
+import requests
+import xarray as xr
+
+from weather.api import extractor
+
+
+def make_response(status_code: int) -> requests.Response:
+  response = requests.Response()
+  response.status_code = status_code
+  response._content = b'{"message": "Too many requests"}'
+  return response
+
+
+class ThrottledSession(requests.Session):
+  """Session answering every CDS API request with HTTP 429."""
+
+  def __init__(self) -> None:
+    super().__init__()
+    self.posts = 0
+
+  def get(self, url, **kwargs) -> requests.Response:
+    return make_response(404)
+
+  def post(self, url, **kwargs) -> requests.Response:
+    self.posts += 1
+    return make_response(429)
+
+
+@pytest.fixture
+def throttled_session(monkeypatch: pytest.MonkeyPatch) -> ThrottledSession:
+  session = ThrottledSession()
+  monkeypatch.setattr(extractor, 'create_http_session', lambda: session)
+  return session
+
+
+def get_extractor(saving_path: Path,
+                  key: str = '1:abc') -> extractor.Era5DataExtractor:
+  location = SimpleNamespace(name='Test_site',
+                             latitude=52.414,
+                             longitude=-1.143,
+                             altitude=90.6,
+                             timezone='UTC')
+  api_client = cdsapi.Client(url='https://cds.example.com/api/v2',
+                             key=key,
+                             quiet=True,
+                             sleep_max=0,
+                             retry_max=3,
+                             session=requests.Session())
+  return extractor.Era5DataExtractor(location,
+                                     api_client=api_client,
+                                     saving_path=saving_path)
+
+
+def test_throttled_request_is_retried_by_cdsapi_only(
+    tmp_path: Path, throttled_session: ThrottledSession) -> None:
+  era5_extractor = get_extractor(tmp_path)
+  with pytest.raises(Exception, match='Could not connect'):
+    era5_extractor.retrieve_variables(['2m_temperature'], 2020, ['01'],
+                                      extractor._ALL_DAYS,
+                                      tmp_path / 'Test_site_2020.nc')
+  assert throttled_session.posts == 3
+
+
+def test_download_workers_reuse_sessions_across_calls(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+  era5_extractor = get_extractor(tmp_path)
+  sessions: list[requests.Session] = []
+  monkeypatch.setattr(
+      era5_extractor, 'retrieve_variables', lambda *job: sessions.append(
+          era5_extractor.get_thread_api_client().session))
+  jobs = [(['2m_temperature'], 2020, ['01'], extractor._ALL_DAYS,
+           era5_extractor.get_download_path(2020))] * 4
+
+  era5_extractor.run_download_jobs(jobs)
+  era5_extractor.run_download_jobs(jobs)
+
+  assert len(sessions) == 8
+  assert len(set(map(id, sessions))) <= extractor.MAX_DOWNLOAD_WORKERS
+
+
+def test_api_clients_do_not_share_credentials(tmp_path: Path) -> None:
+  extractor_a = get_extractor(tmp_path, key='1:aaa')
+  extractor_b = get_extractor(tmp_path, key='2:bbb')
+
+  client_a = extractor_a.get_thread_api_client()
+  client_b = extractor_b.get_thread_api_client()
+
+  assert client_a.session is not client_b.session
+  assert client_a.session.auth == ('1', 'aaa')
+  assert client_b.session.auth == ('2', 'bbb')
+
+
+def test_worker_client_keeps_the_client_settings(tmp_path: Path) -> None:
+  era5_extractor = get_extractor(tmp_path)
+
+  api_client = era5_extractor.get_thread_api_client()
+
+  assert api_client is not era5_extractor.api_client
+  assert api_client.quiet and not api_client.progress
+  assert (api_client.sleep_max, api_client.retry_max) == (0, 3)
+  assert api_client.session is not era5_extractor.api_client.session
+  assert api_client.session.auth == ('1', 'abc')
+  assert api_client.session.headers == era5_extractor.api_client.session.headers
+
+
+def test_failed_download_waits_for_other_jobs(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+  era5_extractor = get_extractor(tmp_path)
+  finished: list[int] = []
+
+  def retrieve_variables(variables, year, *job) -> None:
+    if year == 2020:
+      raise Exception('Request failed')
+    time.sleep(0.2)
+    finished.append(year)
+
+  monkeypatch.setattr(era5_extractor, 'retrieve_variables', retrieve_variables)
+  jobs = [(['2m_temperature'], year, ['01'], extractor._ALL_DAYS,
+           era5_extractor.get_download_path(year)) for year in (2020, 2021)]
+
+  with pytest.raises(Exception, match='Request failed'):
+    era5_extractor.run_download_jobs(jobs)
+  assert finished == [2021]
+
+
+@pytest.mark.parametrize('months, day_count', [(None, 31), (['02'], 28),
+                                               (['04', '06'], 30)])
+def test_download_jobs_request_a_year_at_once(tmp_path: Path, months,
+                                              day_count) -> None:
+  era5_extractor = get_extractor(tmp_path)
+
+  jobs = era5_extractor.get_download_jobs(2023, months)
+
+  assert len(jobs) == 1
+  _, year, _, days, path = jobs[0]
+  assert year == 2023
+  assert days == extractor._ALL_DAYS[:day_count]
+  assert path == era5_extractor.get_download_path(2023)
+
+
+def write_download_file(path: Path, column_names: list[str]) -> None:
+  xr.Dataset(
+      {
+          column_name: (('time', 'latitude', 'longitude'),
+                        np.zeros((1, 1, 1), dtype=np.float32))
+          for column_name in column_names
+      },
+      coords={
+          'time': np.array(['2023-01-01T00:00'], dtype='datetime64[ns]'),
+          'latitude': [52.4],
+          'longitude': [-1.1],
+      }).to_netcdf(path)
+
+
+@pytest.mark.parametrize(
+    'column_names, expected_variables',
+    [(['t2m', 'ssr'], []),
+     (['t2m'], [['surface_net_solar_radiation', '2m_temperature']])])
+def test_download_jobs_check_the_variables_already_downloaded(
+    tmp_path: Path, column_names, expected_variables) -> None:
+  era5_extractor = get_extractor(tmp_path)
+  write_download_file(era5_extractor.get_download_path(2023), column_names)
+
+  jobs = era5_extractor.get_download_jobs(2023)
+
+  assert [job[0] for job in jobs] == expected_variables
@@ -0,0 +1,92 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from weather.api import functions
+from weather.structure import enums
+
+TIMES = pd.date_range('2022-01-01', periods=4, freq='h')
+
+
+def write_expver_file(path: Path, expver: tuple[int, ...] = (1, 5)) -> None:
+  """Write an ERA5 file whose last two hours are only available as ERA5T."""
+  t2m = np.full((len(TIMES), len(expver), 1, 1), np.nan, dtype=np.float32)
+  t2m[:2, 0, 0, 0] = [280, 281]  # ERA5 (expver 1)
+  t2m[2:, -1, 0, 0] = [282, 283]  # ERA5T (expver 5)
+  dataset = xr.Dataset(
+      {'t2m': (('time', 'expver', 'latitude', 'longitude'), t2m)},
+      coords={
+          'time': TIMES,
+          'expver': np.array(expver, dtype=np.int32),
+          'latitude': [52.4],
+          'longitude': [-1.1],
+      })
+  dataset.to_netcdf(path)
+
+
+def test_load_single_netcdf_file_fills_era5_gaps_with_era5t(
+    tmp_path: Path) -> None:
+  path = tmp_path / 'Test_site_2022.nc'
+  write_expver_file(path)
+
+  dataf = functions.load_single_netcdf_file(path,
+                                            enums.ExtractFile.TEMPERATURE)
+
+  np.testing.assert_array_equal(dataf['t2m'], [280, 281, 282, 283])
+
+
+def test_load_netcdf_files_fills_era5_gaps_with_era5t(tmp_path: Path) -> None:
+  write_expver_file(tmp_path / 'Test_site_2022.nc')
+
+  dataf = functions.load_netcdf_files(tmp_path, enums.ExtractFile.TEMPERATURE)
+
+  np.testing.assert_array_equal(dataf['t2m'], [280, 281, 282, 283])
+  assert dataf.index.equals(TIMES.tz_localize('utc').rename('time'))
+
+
+def test_load_single_netcdf_file_without_era5t(tmp_path: Path) -> None:
+  path = tmp_path / 'Test_site_2022.nc'
+  write_expver_file(path, expver=(1, ))
+
+  dataf = functions.load_single_netcdf_file(path,
+                                            enums.ExtractFile.TEMPERATURE)
+
+  np.testing.assert_array_equal(dataf['t2m'], [280, 281, 282, 283])
+
+
+def test_load_single_netcdf_file_without_writable_cache(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+  path = tmp_path / 'Test_site_2022.nc'
+  write_expver_file(path)
+
+  def read_only_to_parquet(*args, **kwargs) -> None:
+    raise PermissionError('Read-only file system')
+
+  monkeypatch.setattr(pd.DataFrame, 'to_parquet', read_only_to_parquet)
+
+  dataf = functions.load_single_netcdf_file(path,
+                                            enums.ExtractFile.TEMPERATURE)
+
+  np.testing.assert_array_equal(dataf['t2m'], [280, 281, 282, 283])
+
+
+def test_load_netcdf_files_ignores_times_off_the_hourly_grid(
+    tmp_path: Path) -> None:
+  write_expver_file(tmp_path / 'Test_site_2022.nc')
+  xr.Dataset(
+      {
+          't2m': (('time', 'latitude', 'longitude'),
+                  np.full((1, 1, 1), 99, dtype=np.float32))
+      },
+      coords={
+          'time': [TIMES[0] + pd.Timedelta(minutes=30)],
+          'latitude': [52.4],
+          'longitude': [-1.1],
+      }).to_netcdf(tmp_path / 'Test_site_t2m_2022.nc')
+
+  dataf = functions.load_netcdf_files(tmp_path, enums.ExtractFile.TEMPERATURE)
+
+  np.testing.assert_array_equal(dataf['t2m'], [280, 281, 282, 283])
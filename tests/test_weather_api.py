@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from weather.api import weather_api
+
+
+@pytest.fixture
+def demo_weather() -> weather_api.WeatherData:
+  location = SimpleNamespace(name='Test_site',
+                             latitude=52.414,
+                             longitude=-1.143,
+                             altitude=90.6,
+                             timezone='UTC')
+  return weather_api.WeatherData(location, 2020)
+
+
+def test_solar_components_are_float32(demo_weather, monkeypatch) -> None:
+  index = pd.date_range('2020-06-01', periods=24, freq='h', tz='UTC')
+  ghi_data = pd.DataFrame({'ghi': np.linspace(0, 500, 24, dtype=np.float32)},
+                          index=index)
+  frames = []
+  monkeypatch.setattr(demo_weather, 'convert_to_poa',
+                      lambda dataf, **kwargs: frames.append(dataf) or dataf)
+
+  demo_weather.add_solar_components_to_ghi_data(ghi_data)
+
+  assert list(frames[0].columns) == ['dni', 'kt', 'airmass', 'ghi', 'dhi']
+  assert (frames[0].dtypes == np.float32).all()
+
+
+def test_solar_position_defaults_to_numpy_and_is_cached(
+    demo_weather, monkeypatch) -> None:
+  index = pd.date_range('2020-06-01', periods=24, freq='h', tz='UTC')
+  calls = []
+  get_solarposition = weather_api.pvlib.solarposition.get_solarposition
+
+  def spy(*args, **kwargs):
+    calls.append(kwargs)
+    return get_solarposition(*args, **kwargs)
+
+  monkeypatch.setattr(weather_api.pvlib.solarposition, 'get_solarposition',
+                      spy)
+
+  solar_position = demo_weather.get_solar_position(index)
+
+  assert demo_weather.get_solar_position(index.copy()) is solar_position
+  assert len(calls) == 1
+  assert calls[0]['method'] == 'nrel_numpy'
+  assert 'numthreads' not in calls[0]
+
+
+def test_era5_temperature_is_aligned_on_the_ghi_times(demo_weather,
+                                                      monkeypatch) -> None:
+  index = pd.date_range('2020-06-01', periods=24, freq='h', tz='UTC')
+  ghi_data = pd.DataFrame({'ghi': np.linspace(0, 500, 24, dtype=np.float32)},
+                          index=index)
+  # Temperature downloaded for fewer hours than the solar radiation
+  temperature_data = pd.DataFrame({'t2m': np.arange(12, dtype=np.float32)},
+                                  index=index[12:])
+
+  class Era5DataExtractor:
+
+    def __init__(self, *args, **kwargs) -> None:
+      pass
+
+    def download_data(self, year: int) -> None:
+      pass
+
+    def get_ghi_data(self, year: int) -> pd.DataFrame:
+      return ghi_data
+
+    def get_temperature_data(self, year: int) -> pd.DataFrame:
+      return temperature_data
+
+  monkeypatch.setattr(weather_api.extractor, 'Era5DataExtractor',
+                      Era5DataExtractor)
+
+  weather_data = demo_weather.get_weather_data_from_era5()
+
+  temperature = weather_data[
+      weather_api.schema.POAWeatherDataSchema.OUTDOOR_AIR_TEMPERATURE]
+  assert temperature.iloc[:12].isna().all()
+  np.testing.assert_array_equal(temperature.iloc[12:], np.arange(12))
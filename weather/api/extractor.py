@@ -1,16 +1,60 @@
+import calendar
+import copy
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
 from pathlib import Path
+from types import MappingProxyType
 
 import cdsapi
 import pandas as pd
+import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 from weather.api import functions
 from weather.structure import enums, protocols
 
 load_dotenv(override=True)
 
+MAX_DOWNLOAD_WORKERS = 2  # parallel CDS retrievals
+MAX_CONCURRENT_REQUESTS = 5  # CDS fair-use limit shared by all extractors
+CDSAPI_SLEEP_MAX = 120  # longest wait in seconds between two queue polls
+CDSAPI_RETRY_MAX = 500  # failed requests tolerated by cdsapi before giving up
+HTTP_POOL_CONNECTIONS = 4  # connection pools kept by each HTTP session
+HTTP_POOL_MAXSIZE = 8  # connections kept in each pool
+
+_request_semaphore = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+# Long-lived pool, so its threads and their API clients outlive each call
+_download_executor = ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS,
+                                        thread_name_prefix='era5_download')
+
+_ALL_DAYS = tuple(f'{d:02d}' for d in range(1, 32))
+_ALL_HOURS = tuple(f'{h:02d}:00' for h in range(24))
+
+# Request fields shared by every ERA5 retrieval, safe to share across threads.
+_ERA5_BASE_REQUEST = MappingProxyType({
+    'format': 'netcdf',
+    'time': _ALL_HOURS,
+})
+
+# (variables, year, months, days, target_path) of a single CDS retrieval.
+DownloadJob = tuple[list[str], int, list[str], tuple[str, ...], Path]
+
+
+def create_http_session() -> requests.Session:
+  """Create a pooled HTTP session for a CDS API client.
+  cdsapi.Client sets its credentials on the session it is given, so each
+  client needs its own session. Retries are left to cdsapi, the adapter does
+  not retry."""
+  session = requests.Session()
+  session.mount(
+      'https://',
+      HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                  pool_maxsize=HTTP_POOL_MAXSIZE))
+  return session
+
 
 @dataclass
 class Era5DataExtractor:
@@ -27,28 +71,50 @@ class Era5DataExtractor:
       
     Methods:
     create_api_client:
-      Create a new CDS API client using the environment variables.
+      Create a new CDS API client using the environment variables and its
+      own pooled HTTP session.
     get_ghi_data:
       Get the GHI data from the extracted netcdf file.
     get_temperature_data:
       Get the temperature data from the extracted netcdf file.
     get_variable_file_path:
-      Get the file path of the variable extracted.
+      Get the file path of the variable extracted, either its own file or the
+      file holding all the variables of the year.
     create_saving_path:
       Create the saving path to save the netcdf files.
     extract_multiple_year:
-      Extract data from multiple years.
+      Download the data of several years through the same worker pool.
     all_monhts:
       Get all months in a list.
     get_box_coordinates:
       Get the box coordinates to extract the data.
+    get_thread_api_client:
+      Get the copy of the CDS API client used by the current thread.
     download_data:
       Download the data from the CDS API.
+    get_download_jobs:
+      Get the retrieval needed to download the missing variables of a year of
+      data in a single request.
+    get_download_path:
+      Get the path of the netcdf file holding all the variables of a year.
+    get_single_variable_path:
+      Get the path of the netcdf file holding a single variable of a year.
+    run_download_jobs:
+      Run the retrievals in parallel on a bounded thread pool and wait for all
+      of them.
+    retrieve_variables:
+      Retrieve several variables in one request.
     """
   location: protocols.Location
   api_client: cdsapi.Client | None = None
   saving_path: Path = Path(r'..')
   variables_to_extract: list[str] = field(default_factory=list)
+  _thread_local: threading.local = field(default_factory=threading.local,
+                                         init=False,
+                                         repr=False)
+  _box_coordinates: tuple[float, ...] = field(default=(),
+                                              init=False,
+                                              repr=False)
 
   def __post_init__(self) -> None:
     if self.api_client is None:
@@ -57,6 +123,7 @@ class Era5DataExtractor:
         enums.ExtractFile.SOLARRADIATION.filename_key,
         enums.ExtractFile.TEMPERATURE.filename_key
     ]
+    self._box_coordinates = tuple(self.get_box_coordinates())
     self.create_saving_path()
 
   def create_api_client(self):
@@ -66,7 +133,10 @@ class Era5DataExtractor:
     try:
       self.api_client = cdsapi.Client(key=CDSAPI_KEY,
                                       url=CDSAPI_URL,
-                                      verify=True)
+                                      verify=True,
+                                      sleep_max=CDSAPI_SLEEP_MAX,
+                                      retry_max=CDSAPI_RETRY_MAX,
+                                      session=create_http_session())
     except AssertionError as e:
       print(f'Error: {e}')
     #   print(f'Error: {e}')
@@ -87,10 +157,14 @@ class Era5DataExtractor:
 
   def get_variable_file_path(self, variable: enums.ExtractFile,
                              year: int) -> Path:
-    """Get the file path of the variable extracted."""
-    filename = f'{self.location.name}_{variable.filename_key}_{year}.nc'
-    print(self.saving_path / filename)
-    return self.saving_path / filename
+    """Get the file path of the variable extracted, either its own file or the
+    file holding all the variables of the year."""
+    variable_file_path = self.get_single_variable_path(variable.filename_key,
+                                                       year)
+    if not variable_file_path.exists():
+      variable_file_path = self.get_download_path(year)
+    print(variable_file_path)
+    return variable_file_path
 
   def create_saving_path(self, saving_path: Path | None = None) -> None:
     """Create the saving path to save the netcdf files."""
@@ -101,8 +175,14 @@ class Era5DataExtractor:
     path_netcdf_files.mkdir(parents=True, exist_ok=True)
     self.saving_path = path_netcdf_files
 
-  def extract_multiple_year(self):
-    pass
+  def extract_multiple_year(self,
+                            years: list[int],
+                            months: list[str] | None = None) -> None:
+    """Download the data of several years through the same worker pool."""
+    jobs = [
+        job for year in years for job in self.get_download_jobs(year, months)
+    ]
+    self.run_download_jobs(jobs)
 
   def all_monhts(self) -> list[str]:
     """Get all months in a list."""
@@ -116,88 +196,87 @@ class Era5DataExtractor:
     ]
     return box_coordinates
 
-  def download_data(self, year: int, months: list[str] | None = None):
-    """Download the data from the CDS API."""
+  def get_thread_api_client(self) -> cdsapi.Client:
+    """Get the CDS API client of the current thread.
+    cdsapi.Client is not thread-safe, so each worker uses a copy of the
+    extractor's client with the same settings and its own HTTP session, kept
+    across calls."""
+    api_client = getattr(self._thread_local, 'api_client', None)
+    if api_client is None:
+      api_client = copy.copy(self.api_client)
+      api_client.session = create_http_session()
+      api_client.session.auth = self.api_client.session.auth
+      api_client.session.headers = self.api_client.session.headers.copy()
+      self._thread_local.api_client = api_client
+    return api_client
+
+  def get_download_jobs(self,
+                        year: int,
+                        months: list[str] | None = None) -> list[DownloadJob]:
+    """Get the retrieval needed to download the missing variables of a year of
+    data in a single request. The days are trimmed only when all the months
+    have the same length; CDS skips the days a month does not have.
+    The file holding all the variables is downloaded again with every variable
+    without its own file when it lacks any of them."""
+    missing = [
+        variable for variable in self.variables_to_extract
+        if not self.get_single_variable_path(variable, year).exists()
+    ]
+    column_names = {
+        extract_file.filename_key: extract_file.column_name
+        for extract_file in enums.ExtractFile
+    }
+    downloaded = functions.get_netcdf_variables(self.get_download_path(year))
+    if all(column_names[variable] in downloaded for variable in missing):
+      print(f'All {year} files already exist in {self.saving_path}.')
+      return []
+
     if months is None:
       months = self.all_monhts()
+    day_counts = {calendar.monthrange(year, int(month))[1] for month in months}
+    days = _ALL_DAYS[:day_counts.pop()] if len(day_counts) == 1 else _ALL_DAYS
+    return [(missing, year, months, days, self.get_download_path(year))]
+
+  def get_download_path(self, year: int) -> Path:
+    """Get the path of the netcdf file holding all the variables of a year."""
+    return self.saving_path / f'{self.location.name}_{year}.nc'
+
+  def get_single_variable_path(self, variable: str, year: int) -> Path:
+    """Get the path of the netcdf file holding a single variable of a year."""
+    return self.saving_path / f'{self.location.name}_{variable}_{year}.nc'
+
+  def run_download_jobs(self, jobs: list[DownloadJob]) -> None:
+    """Run the retrievals in parallel on a bounded thread pool.
+    All the retrievals are waited for before the first error is raised, so
+    none is left running in the background."""
+    if not jobs:
+      return
+    futures = [
+        _download_executor.submit(self.retrieve_variables, *job)
+        for job in jobs
+    ]
+    wait(futures)
+    for future in futures:
+      future.result()
+
+  def download_data(self, year: int, months: list[str] | None = None):
+    """Download the data from the CDS API."""
+    self.run_download_jobs(self.get_download_jobs(year, months))
 
-    for variable in self.variables_to_extract:
-      filename = f'{self.location.name}_{variable}_{year}.nc'
-      temp_full_path = self.saving_path / filename
-      print(f'Check if {temp_full_path} already exists...')
-      if not temp_full_path.exists():
-        print('File does not exist')
-        temp_result = self.api_client.retrieve(
-            'reanalysis-era5-land', {
-                'format':
-                'netcdf',
-                'variable':
-                f'{variable}',
-                'year':
-                f'{year}',
-                'month':
-                months,
-                'day': [
-                    '01',
-                    '02',
-                    '03',
-                    '04',
-                    '05',
-                    '06',
-                    '07',
-                    '08',
-                    '09',
-                    '10',
-                    '11',
-                    '12',
-                    '13',
-                    '14',
-                    '15',
-                    '16',
-                    '17',
-                    '18',
-                    '19',
-                    '20',
-                    '21',
-                    '22',
-                    '23',
-                    '24',
-                    '25',
-                    '26',
-                    '27',
-                    '28',
-                    '29',
-                    '30',
-                    '31',
-                ],
-                'time': [
-                    '00:00',
-                    '01:00',
-                    '02:00',
-                    '03:00',
-                    '04:00',
-                    '05:00',
-                    '06:00',
-                    '07:00',
-                    '08:00',
-                    '09:00',
-                    '10:00',
-                    '11:00',
-                    '12:00',
-                    '13:00',
-                    '14:00',
-                    '15:00',
-                    '16:00',
-                    '17:00',
-                    '18:00',
-                    '19:00',
-                    '20:00',
-                    '21:00',
-                    '22:00',
-                    '23:00',
-                ],
-                'area':
-                self.get_box_coordinates(),
-            }, f'{temp_full_path}')
-      else:
-        print(f'{temp_full_path} already exists.')
+  def retrieve_variables(self, variables: list[str], year: int,
+                         months: list[str], days: tuple[str, ...],
+                         temp_full_path: Path) -> None:
+    """Retrieve several variables in one request.
+    Throttled (HTTP 429) and failed requests are retried by cdsapi itself, up
+    to retry_max times, sleep_max seconds apart."""
+    request = {
+        **_ERA5_BASE_REQUEST,
+        'variable': variables,
+        'year': f'{year}',
+        'month': months,
+        'day': days,
+        'area': self._box_coordinates,
+    }
+    api_client = self.get_thread_api_client()
+    with _request_semaphore:
+      api_client.retrieve('reanalysis-era5-land', request, f'{temp_full_path}')
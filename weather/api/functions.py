@@ -1,7 +1,8 @@
 from pathlib import Path
 
+import netCDF4
+import numpy as np
 import pandas as pd
-import xarray as xr
 
 from weather.structure import enums, schema
 
@@ -48,18 +49,38 @@ def get_radiation_data(path_netcdf_file: Path) -> pd.DataFrame:
   if path_netcdf_file.exists():
     # Load data
     radiation_data = load_single_netcdf_file(path_netcdf_file, target_variable)
-    radiation_data = radiation_data - radiation_data.shift()
-    radiation_data.fillna(0, inplace=True)
-    radiation_data[radiation_data < 0] = 0
-    radiation_data[target_variable.column_name] = (
-        radiation_data[target_variable.column_name] / 3600
-    )  # convert from J/m2 to W/m2
+    radiation_data[target_variable.column_name] = deaccumulate_radiation(
+        radiation_data[target_variable.column_name].to_numpy(dtype=np.float32))
   else:
     radiation_data = pd.DataFrame(columns=[target_variable.column_name])
 
   return apply_outputdataschema(radiation_data, target_variable)
 
 
+def deaccumulate_radiation(accumulated: np.ndarray) -> np.ndarray:
+  """Convert hourly accumulated radiation (J/m2) into mean irradiance (W/m2).
+  Differences, clipping and scaling are fused in a single output array."""
+  radiation = np.empty_like(accumulated)
+  if radiation.size == 0:
+    return radiation
+  radiation[0] = 0
+  np.subtract(accumulated[1:], accumulated[:-1], out=radiation[1:])
+  np.fmax(radiation, 0, out=radiation)  # also replaces missing values by 0
+  np.multiply(radiation, 1 / 3600, out=radiation)  # convert from J/m2 to W/m2
+  return radiation
+
+
+def get_diffuse_irradiance(ghi: np.ndarray, zenith: np.ndarray,
+                           dni: np.ndarray) -> np.ndarray:
+  """Get the diffuse horizontal irradiance from GHI = DNI*cos(zenith) + DHI.
+  Every step is written into the output array, zenith is in degrees."""
+  dhi = np.multiply(zenith, np.pi / 180, dtype=ghi.dtype)
+  np.cos(dhi, out=dhi)
+  np.multiply(dhi, dni, out=dhi)
+  np.subtract(ghi, dhi, out=dhi)
+  return dhi
+
+
 def get_temperature_data(path_netcdf_file: Path) -> pd.DataFrame:
   """Get the temperature data from the extracted netcdf file."""
   target_variable = enums.ExtractFile.TEMPERATURE
@@ -78,43 +99,100 @@ def get_temperature_data(path_netcdf_file: Path) -> pd.DataFrame:
 def load_single_netcdf_file(
     path_netcdf_file: Path,
     target_variable: enums.ExtractFile) -> pd.DataFrame:
-  """Load a single netcdf file and transform it into a dataframe."""
-  temp_xarray = xr.open_dataset(path_netcdf_file)
-  temp_dataf = temp_xarray.to_dataframe()
-
-  temp_dataf = temp_dataf.reset_index()
-  if 'expver' in temp_dataf.columns:
-    filt = temp_dataf['expver'] == 1
-    df1 = temp_dataf.loc[filt, ['time', target_variable.column_name]].copy()
-    df1.set_index('time', inplace=True)
-    filt = temp_dataf['expver'] == 5
-    df2 = temp_dataf.loc[filt, ['time', target_variable.column_name]].copy()
-    df2.set_index('time', inplace=True)
-    temp_dataf = df1.combine_first(df2)
-
-  else:
-    temp_dataf = temp_dataf[['time', target_variable.column_name]]
-    temp_dataf = temp_dataf.set_index('time', drop=True)
-  temp_dataf.index = temp_dataf.index.tz_localize('UTC')
+  """Load a single netcdf file and transform it into a dataframe.
+  The dataframe is cached in a parquet file next to the netcdf file and read
+  from there as long as the cache is newer than the netcdf file. Failing to
+  write the cache does not prevent the load."""
+  path_cache = get_netcdf_cache_path(path_netcdf_file, target_variable)
+  if (path_cache.exists()
+      and path_cache.stat().st_mtime >= path_netcdf_file.stat().st_mtime):
+    return pd.read_parquet(path_cache)
+
+  with netCDF4.Dataset(path_netcdf_file, 'r') as dataset:
+    times, values = read_netcdf_variable(dataset, target_variable)
+  temp_dataf = pd.DataFrame({target_variable.column_name: values},
+                            index=times.tz_localize('UTC'))
+  try:
+    temp_dataf.to_parquet(path_cache, compression='zstd')
+  except OSError as e:
+    # The cache is optional, e.g. the netcdf directory may be read-only
+    print(f'Could not cache {path_netcdf_file.name}: {e}')
   return temp_dataf
 
 
+def read_netcdf_variable(
+    dataset: netCDF4.Dataset,
+    target_variable: enums.ExtractFile) -> tuple[pd.DatetimeIndex, np.ndarray]:
+  """Read the hourly values of a variable at the first grid point of a netcdf
+  dataset. ERA5 (expver 1) values are used and their gaps are filled with
+  ERA5T (expver 5) values when the file holds any."""
+  time = dataset['time']
+  times = netCDF4.num2date(time[:],
+                           time.units,
+                           calendar=getattr(time, 'calendar', 'standard'),
+                           only_use_cftime_datetimes=False,
+                           only_use_python_datetimes=True)
+  variable = dataset[target_variable.column_name]
+  dimensions = list(variable.dimensions)
+  values = np.ma.filled(variable[:].astype(np.float32), np.nan)
+  if 'expver' in dimensions:
+    expver = list(dataset['expver'][:])
+    axis = dimensions.index('expver')
+    dimensions.pop(axis)
+    era5 = np.take(values, expver.index(1), axis=axis)
+    if 5 in expver:
+      era5t = np.take(values, expver.index(5), axis=axis)
+      era5 = np.where(np.isnan(era5), era5t, era5)
+    values = era5
+
+  # Keep the first grid point of the extracted area
+  values = np.moveaxis(values, dimensions.index('time'), 0)
+  values = values.reshape(len(times), -1)[:, 0]
+  return pd.DatetimeIndex(times, name='time'), values
+
+
+def get_netcdf_variables(path_netcdf_file: Path) -> set[str]:
+  """Get the names of the variables held by a netcdf file, none when the file
+  does not exist."""
+  if not path_netcdf_file.exists():
+    return set()
+  with netCDF4.Dataset(path_netcdf_file, 'r') as dataset:
+    return set(dataset.variables)
+
+
+def get_netcdf_cache_path(path_netcdf_file: Path,
+                          target_variable: enums.ExtractFile) -> Path:
+  """Get the path of the parquet file caching a variable of a netcdf file."""
+  return path_netcdf_file.with_name(
+      f'{path_netcdf_file.stem}_{target_variable.column_name}.parquet')
+
+
 def load_netcdf_files(path_directory: Path,
                       target_variable: enums.ExtractFile) -> pd.DataFrame:
-  """Load netcdf file and transform them into dataframes."""
-  pathlist = path_directory.rglob('*.nc')
-  frames: list[pd.DataFrame] = []
-  for path in pathlist:
-    if target_variable.filename_key in path.stem:
-      temp_xarray = xr.open_dataset(path)
-      temp_dataf = temp_xarray.to_dataframe()
-      temp_dataf = temp_dataf.unstack([0, 1]).iloc[:, 0]
-      temp_dataf = temp_dataf.to_frame()
-      temp_dataf.columns = temp_dataf.columns.get_level_values(0)
-      frames.append(temp_dataf)
-  if len(frames) > 0:
-    concat_dataf = pd.concat(frames)
-    concat_dataf.index = concat_dataf.index.tz_localize('utc')
-  else:
-    concat_dataf = pd.DataFrame(columns=[target_variable.column_name])
-  return concat_dataf
+  """Load netcdf files and transform them into a single hourly dataframe.
+  The output is allocated once over the period covered by the files and
+  filled file by file, hours missing from the files are left empty and times
+  off the hourly grid are ignored."""
+  file_data: list[tuple[pd.DatetimeIndex, np.ndarray]] = []
+  for path in path_directory.rglob('*.nc'):
+    # Files hold either a single variable or all the variables of a year
+    with netCDF4.Dataset(path, 'r') as dataset:
+      if target_variable.column_name in dataset.variables:
+        file_data.append(read_netcdf_variable(dataset, target_variable))
+  if len(file_data) == 0:
+    return pd.DataFrame(columns=[target_variable.column_name])
+
+  date_index = pd.date_range(start=min(times.min() for times, _ in file_data),
+                             end=max(times.max() for times, _ in file_data),
+                             freq='h',
+                             name='time')
+
+  values = np.full(len(date_index), np.nan, dtype=np.float32)
+  for times, file_values in file_data:
+    positions = date_index.get_indexer(times)
+    # Times off the hourly grid have no position (-1) and are dropped
+    on_grid = positions >= 0
+    values[positions[on_grid]] = file_values[on_grid]
+
+  return pd.DataFrame({target_variable.column_name: values},
+                      index=date_index.tz_localize('utc'))
@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+import os
+from dataclasses import dataclass, field
 from pathlib import Path
 
 import numpy as np
@@ -6,7 +7,7 @@ import pandas as pd
 import pvlib
 from e2slib.utillib import functions as e2s_functions
 
-from weather.api import extractor
+from weather.api import extractor, functions
 from weather.structure import enums, protocols, schema
 
 
@@ -22,6 +23,12 @@ class WeatherData:
       Source of the weather data.
     saving_path: Path
       Path to save the weather data.
+    file_format: enums.WeatherFileFormat
+      Format of the saved weather data. Parquet by default, CSV is kept for
+      backward compatibility.
+    solar_position_method: str
+      pvlib solar position method. 'nrel_numpy' by default; 'nrel_numba'
+      only pays off on long indexes as it compiles the SPA on first use.
   
   Methods:
     start_date() -> pd.Timestamp
@@ -32,7 +39,9 @@ class WeatherData:
       Get the location of the site.
     get_weather_data_source() -> enums.WeatherDataSource
       Get the weather data source.
-    convert_to_poa(dataf: pd.DataFrame) -> pd.DataFrame
+    get_solar_position(index: pd.DatetimeIndex) -> pd.DataFrame
+      Get the solar position of each timestamp of the index.
+    convert_to_poa(dataf: pd.DataFrame, solar_position: pd.DataFrame | None = None, airmass: pd.DataFrame | None = None) -> pd.DataFrame
       Convert a dataframe with dni, ghi, dhi, apparent_zenith, azimuth and airmass_relative to poa.
     get_clearsky_solar_data() -> pd.DataFrame
       Get the clearsky solar data.
@@ -53,11 +62,15 @@ class WeatherData:
     get_weather_data(weather_data_source: enums.WeatherDataSource | None = None) -> pd.DataFrame
       Get the weather data.
     save_weather_data(dataf: pd.DataFrame) -> None
-      Save the weather data."""
+      Save the weather data as parquet or CSV depending on file_format."""
   geolocation: protocols.Location
   simulation_year: int
   weather_data_source: enums.WeatherDataSource = enums.WeatherDataSource.ERA5
   saving_path: Path = Path(r'..')
+  file_format: enums.WeatherFileFormat = enums.WeatherFileFormat.PARQUET
+  solar_position_method: str = 'nrel_numpy'
+  _solar_position_cache: tuple[pd.DatetimeIndex, pd.DataFrame] | None = field(
+      default=None, init=False, repr=False)
 
   def __post_init__(self):
     print(f"The results will be stored at:\n{self.saving_path.resolve()}")
@@ -79,14 +92,44 @@ class WeatherData:
     """Get the weather data source."""
     return self.weather_data_source
 
-  def convert_to_poa(self, dataf: pd.DataFrame) -> pd.DataFrame:
-    """Convert a dataframe with dni, ghi, dhi, apparent_zenith, azimuth and airmass_relative to poa"""
+  def get_solar_position(self, index: pd.DatetimeIndex) -> pd.DataFrame:
+    """Get the solar position of each timestamp of the index.
+    Reuses the last result when called again with the same index."""
+    if self._solar_position_cache is not None:
+      cached_index, cached_solar_position = self._solar_position_cache
+      if cached_index.equals(index):
+        return cached_solar_position
+
+    location = self.location
+    kwargs = {}
+    if self.solar_position_method == 'nrel_numba':
+      kwargs['numthreads'] = os.cpu_count() or 1
+    solar_position = pvlib.solarposition.get_solarposition(
+        index,
+        location.latitude,
+        location.longitude,
+        altitude=location.altitude,
+        pressure=pvlib.atmosphere.alt2pres(location.altitude),
+        method=self.solar_position_method,
+        **kwargs)
+    self._solar_position_cache = (index, solar_position)
+    return solar_position
+
+  def convert_to_poa(self,
+                     dataf: pd.DataFrame,
+                     solar_position: pd.DataFrame | None = None,
+                     airmass: pd.DataFrame | None = None) -> pd.DataFrame:
+    """Convert a dataframe with dni, ghi, dhi, apparent_zenith, azimuth and airmass_relative to poa.
+    The solar position and airmass are computed from the index unless given."""
 
     # Calculate solar position for each timestamp in weather_data data
-    solar_position = self.location.get_solarposition(dataf.index)
+    if solar_position is None:
+      solar_position = self.get_solar_position(dataf.index)
 
     # Calculate airmass for each timestamp in weather_data data
-    airmass = self.location.get_airmass(dataf.index)
+    if airmass is None:
+      airmass = self.location.get_airmass(dataf.index,
+                                          solar_position=solar_position)
 
     # Calculate POA irradiance for each timestamp in weather_data data
     dataf = pvlib.irradiance.get_total_irradiance(
@@ -158,12 +201,13 @@ class WeatherData:
     site_era5_extractor.download_data(self.simulation_year)
 
     ghi_data = site_era5_extractor.get_ghi_data(self.simulation_year)
-    weather_data = self.add_solar_components_to_ghi_data(ghi_data).copy()
+    weather_data = self.add_solar_components_to_ghi_data(ghi_data)
     temperature_data = site_era5_extractor.get_temperature_data(
         self.simulation_year)
-    weather_data.loc[:, schema.POAWeatherDataSchema.
-                     OUTDOOR_AIR_TEMPERATURE] = temperature_data.values.flatten(
-                     )
+    # The variables may come from different files, so align them on the time
+    air_temperature_col = schema.POAWeatherDataSchema.OUTDOOR_AIR_TEMPERATURE
+    weather_data[air_temperature_col] = temperature_data.iloc[:, 0].reindex(
+        weather_data.index).to_numpy()
     return weather_data
 
   def add_solar_components_to_ghi_data(self,
@@ -171,19 +215,30 @@ class WeatherData:
     """Add solar components to the GHI data."""
     ghi_data.columns = ['ghi']
     # Calculate solar position for each timestamp in weather_data data
-    solar_position: pd.DataFrame = self.location.get_solarposition(
-        ghi_data.index)
+    solar_position = self.get_solar_position(ghi_data.index)
     dni_data: pd.DataFrame = pvlib.irradiance.disc(
         ghi_data['ghi'].values,
         solar_zenith=solar_position['zenith'],
         datetime_or_doy=ghi_data.index)
-    weather_data: pd.DataFrame = pd.concat([dni_data, ghi_data], axis=1)
-    # weather_data = pd.concat([weather_data, temperature_data], axis=1)
-    weather_data['dhi'] = (
-        weather_data['ghi'] -
-        np.cos(solar_position['zenith'] * np.pi / 180) * weather_data['dni']
-    )  # GHI = DNI*cosθ + DHI
-    return self.convert_to_poa(weather_data)
+    dni_arr = dni_data['dni'].to_numpy(dtype=np.float32)
+    ghi_arr = ghi_data['ghi'].to_numpy(dtype=np.float32)
+    dhi_arr = functions.get_diffuse_irradiance(
+        ghi_arr, solar_position['zenith'].to_numpy(), dni_arr)
+    # Build all columns at once to avoid fragmenting the dataframe
+    weather_data = pd.DataFrame(
+        {
+            'dni': dni_arr,
+            'kt': dni_data['kt'].to_numpy(dtype=np.float32),
+            'airmass': dni_data['airmass'].to_numpy(dtype=np.float32),
+            'ghi': ghi_arr,
+            'dhi': dhi_arr,
+        },
+        index=ghi_data.index)
+    airmass = self.location.get_airmass(ghi_data.index,
+                                        solar_position=solar_position)
+    return self.convert_to_poa(weather_data,
+                               solar_position=solar_position,
+                               airmass=airmass)
 
   def get_date_range(self) -> pd.DatetimeIndex:
     """Get the date range of the simulation year."""
@@ -196,7 +251,7 @@ class WeatherData:
     """Resample and fill missing data."""
     date_range = self.get_date_range()
     dataf = e2s_functions.resample_and_fill_missing_data(dataf, freq="30min")
-    dataf = pd.concat([pd.DataFrame(index=date_range), dataf], axis=1)
+    dataf = dataf.reindex(index=date_range)
     return e2s_functions.fill_missing_data(dataf)
 
   def get_weather_data(
@@ -221,9 +276,14 @@ class WeatherData:
     return dataf
 
   def save_weather_data(self, dataf: pd.DataFrame) -> None:
-    """Save the weather data."""
-    filename = f'Weather_data_{self.weather_data_source.name.lower()}_{self.simulation_year}.csv'
+    """Save the weather data as parquet or CSV depending on file_format."""
+    filename = f'Weather_data_{self.weather_data_source.name.lower()}_{self.simulation_year}.{self.file_format}'
     path_saving_weather_data = self.saving_path / 'weather_data'
 
     path_saving_weather_data.mkdir(parents=True, exist_ok=True)
-    dataf.to_csv(path_saving_weather_data / f'{filename}')
+    if self.file_format is enums.WeatherFileFormat.CSV:
+      dataf.to_csv(path_saving_weather_data / f'{filename}')
+    else:
+      dataf.to_parquet(path_saving_weather_data / f'{filename}',
+                       compression='zstd',
+                       index=True)
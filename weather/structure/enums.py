@@ -8,6 +8,11 @@ class WeatherDataSource(StrEnum):
   PVGISSARAH2 = auto()
 
 
+class WeatherFileFormat(StrEnum):
+  PARQUET = auto()
+  CSV = auto()
+
+
 class WeatherDataFormat(Enum):
   POA = auto(
   )  #based on direct, diffuse and total irradiance in the plane of array ('poa_global', 'poa_direct', 'poa_diffuse').